@@ -2,6 +2,7 @@ import argparse
 import glob
 import json
 import os
+import sys
 from dataclasses import dataclass, field, fields
 from enum import Enum, StrEnum
 from pathlib import Path
@@ -9,6 +10,11 @@ from typing import Any, Optional, Sequence, Union
 
 import shtab
 
+try:
+    import orjson
+except ModuleNotFoundError:  # pragma: nocover
+    orjson = None
+
 from vectorcode import __version__
 
 PathLike = Union[str, Path]
@@ -320,6 +326,20 @@ async def parse_cli_args(args: Optional[Sequence[str]] = None):
     )
 
 
+def print_json(obj: Any):
+    """
+    Print `obj` as JSON for the `--pipe` mode.
+    When orjson is available, its UTF-8 output is written to the binary buffer of
+    STDOUT directly, because it doesn't escape non-ASCII characters.
+    """
+    if orjson is None or not hasattr(sys.stdout, "buffer"):
+        print(json.dumps(obj))
+        return
+    sys.stdout.flush()
+    sys.stdout.buffer.write(orjson.dumps(obj) + b"\n")
+    sys.stdout.buffer.flush()
+
+
 def expand_envs_in_dict(d: dict):
     if not isinstance(d, dict):
         return
@@ -1,48 +1,92 @@
 import asyncio
 import hashlib
+import json
 import os
+import random
 import socket
 import subprocess
 import sys
-from typing import AsyncGenerator
+import weakref
+from dataclasses import dataclass, field
+from typing import AsyncGenerator, Iterable
 
 import chromadb
 import httpx
 from chromadb.api import AsyncClientAPI
 from chromadb.api.models.AsyncCollection import AsyncCollection
+from chromadb.api.types import IncludeEnum
 from chromadb.config import Settings
 from chromadb.utils import embedding_functions
 
 from vectorcode.cli_utils import Config, expand_path
 
+HOSTNAME = socket.gethostname()
+USERNAME = os.environ.get("USER", os.environ.get("USERNAME", "DEFAULT_USER"))
+# usernames that a collection created on this machine may have been tagged with.
+VALID_USERNAMES = frozenset(
+    (os.environ.get("USER"), os.environ.get("USERNAME"), "DEFAULT_USER")
+)
+
 
 async def get_collections(
     client: AsyncClientAPI,
 ) -> AsyncGenerator[AsyncCollection, None]:
-    for collection_name in await client.list_collections():
-        collection = await client.get_collection(collection_name, None)
+    collection_names = await client.list_collections()
+    # fetch all collections concurrently instead of one round-trip at a time.
+    collections = await asyncio.gather(
+        *(client.get_collection(name, None) for name in collection_names)
+    )
+    for collection in collections:
         meta = collection.metadata
         if meta is None:
             continue
         if meta.get("created-by") != "VectorCode":
             continue
-        if meta.get("username") not in (
-            os.environ.get("USER"),
-            os.environ.get("USERNAME"),
-            "DEFAULT_USER",
-        ):
+        if meta.get("username") not in VALID_USERNAMES:
             continue
-        if meta.get("hostname") != socket.gethostname():
+        if meta.get("hostname") != HOSTNAME:
             continue
         yield collection
 
 
+# keyed weakly, so that a client doesn't keep the loop of a finished `asyncio.run` alive.
+__HTTP_CLIENT_CACHE: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, httpx.AsyncClient
+] = weakref.WeakKeyDictionary()
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Return the `httpx.AsyncClient` shared by the heartbeat checks, so that repeated
+    checks reuse the same keep-alive connection.
+    The client is bound to the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = __HTTP_CLIENT_CACHE.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            timeout=5.0,
+        )
+        __HTTP_CLIENT_CACHE[loop] = client
+    return client
+
+
+async def close_http_client():
+    """
+    Close the client of the running event loop. This should be called before the
+    loop shuts down.
+    """
+    client = __HTTP_CLIENT_CACHE.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
 async def try_server(host: str, port: int):
     url = f"http://{host}:{port}/api/v1/heartbeat"
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url=url)
-            return response.status_code == 200
+        response = await get_http_client().get(url=url)
+        return response.status_code == 200
     except (httpx.ConnectError, httpx.ConnectTimeout):
         return False
 
@@ -51,19 +95,23 @@ async def wait_for_server(host, port, timeout=10):
     # Poll the server until it's ready or timeout is reached
     url = f"http://{host}:{port}/api/v1/heartbeat"
     start_time = asyncio.get_event_loop().time()
-    async with httpx.AsyncClient() as client:
-        while True:
-            try:
-                response = await client.get(url)
-                if response.status_code == 200:
-                    return
-            except httpx.RequestError:
-                pass  # Server is not yet ready
+    client = get_http_client()
+    delay = 0.01
+    while True:
+        try:
+            # a hung server shouldn't use up the whole timeout in a single attempt.
+            response = await client.get(url, timeout=0.5)
+            if response.status_code == 200:
+                return
+        except httpx.RequestError:
+            pass  # Server is not yet ready
 
-            if asyncio.get_event_loop().time() - start_time > timeout:
-                raise TimeoutError(f"Server did not start within {timeout} seconds.")
+        if asyncio.get_event_loop().time() - start_time > timeout:
+            raise TimeoutError(f"Server did not start within {timeout} seconds.")
 
-            await asyncio.sleep(0.1)  # Wait before retrying
+        # Exponential backoff with jitter before retrying
+        await asyncio.sleep(delay + random.uniform(0, delay / 4))
+        delay = min(delay * 1.5, 0.2)
 
 
 async def start_server(configs: Config):
@@ -125,26 +173,69 @@ async def get_client(configs: Config) -> AsyncClientAPI:
 
 
 def get_collection_name(full_path: str) -> str:
+    """
+    The collection name is persisted in the database, so the hash function must
+    not change. `hashlib.sha256` is backed by OpenSSL, which already uses the
+    SHA extensions of the CPU when they're available.
+    """
     full_path = str(expand_path(full_path, absolute=True))
-    hasher = hashlib.sha256()
-    hasher.update(
-        f"{os.environ.get('USER', os.environ.get('USERNAME', 'DEFAULT_USER'))}@{socket.gethostname()}:{full_path}".encode()
-    )
-    collection_id = hasher.hexdigest()[:63]
+    collection_id = hashlib.sha256(
+        f"{USERNAME}@{HOSTNAME}:{full_path}".encode()
+    ).hexdigest()[:63]
     return collection_id
 
 
+def get_torch_device() -> str:
+    """
+    Pick the fastest available device for the torch backend of sentence transformers.
+    """
+    import torch
+
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+__EMBEDDING_FUNCTION_CACHE: dict[tuple[str, str], chromadb.EmbeddingFunction] = {}
+
+
 def get_embedding_function(configs: Config) -> chromadb.EmbeddingFunction:
+    """
+    The embedding functions are cached by their names and parameters, so that the
+    models are only loaded once per process.
+    """
+    # the parameters may contain unhashable values, like `model_kwargs`.
+    cache_key = (
+        configs.embedding_function,
+        json.dumps(configs.embedding_params, sort_keys=True, default=str),
+    )
+    if __EMBEDDING_FUNCTION_CACHE.get(cache_key) is not None:
+        return __EMBEDDING_FUNCTION_CACHE[cache_key]
+
+    embedding_params = configs.embedding_params
+    if (
+        configs.embedding_function == "SentenceTransformerEmbeddingFunction"
+        and "device" not in embedding_params
+        and embedding_params.get("backend", "torch") == "torch"
+    ):
+        # chromadb defaults to CPU.
+        embedding_params = {**embedding_params, "device": get_torch_device()}
     try:
-        return getattr(embedding_functions, configs.embedding_function)(
-            **configs.embedding_params
+        embedding_function = getattr(embedding_functions, configs.embedding_function)(
+            **embedding_params
         )
     except AttributeError:
         print(
             f"Failed to use {configs.embedding_function}. Falling back to Sentence Transformer.",
             file=sys.stderr,
         )
-        return embedding_functions.SentenceTransformerEmbeddingFunction()
+        embedding_function = embedding_functions.SentenceTransformerEmbeddingFunction(
+            device=get_torch_device()
+        )
+    __EMBEDDING_FUNCTION_CACHE[cache_key] = embedding_function
+    return embedding_function
 
 
 __COLLECTION_CACHE: dict[str, AsyncCollection] = {}
@@ -164,11 +255,9 @@ async def get_collection(
         embedding_function = get_embedding_function(configs)
         collection_meta = {
             "path": full_path,
-            "hostname": socket.gethostname(),
+            "hostname": HOSTNAME,
             "created-by": "VectorCode",
-            "username": os.environ.get(
-                "USER", os.environ.get("USERNAME", "DEFAULT_USER")
-            ),
+            "username": USERNAME,
             "embedding_function": configs.embedding_function,
         }
 
@@ -183,13 +272,8 @@ async def get_collection(
                 embedding_function=embedding_function,
             )
             if (
-                not collection.metadata.get("hostname") == socket.gethostname()
-                or collection.metadata.get("username")
-                not in (
-                    os.environ.get("USER"),
-                    os.environ.get("USERNAME"),
-                    "DEFAULT_USER",
-                )
+                not collection.metadata.get("hostname") == HOSTNAME
+                or collection.metadata.get("username") not in VALID_USERNAMES
                 or not collection.metadata.get("created-by") == "VectorCode"
             ):
                 raise IndexError(
@@ -199,6 +283,40 @@ async def get_collection(
     return __COLLECTION_CACHE[full_path]
 
 
+@dataclass
+class CollectionSnapshot:
+    """
+    The chunk ids in a collection, grouped by the path of their files.
+    This is built from a single `collection.get` call, so that the different steps
+    of a subcommand don't have to fetch the metadata again.
+    """
+
+    ids_by_path: dict[str, list[str]] = field(default_factory=dict)
+    num_chunks: int = 0
+
+    @classmethod
+    async def fetch(cls, collection: AsyncCollection) -> "CollectionSnapshot":
+        result = await collection.get(include=[IncludeEnum.metadatas])
+        ids_by_path: dict[str, list[str]] = {}
+        for chunk_id, meta in zip(result["ids"], result.get("metadatas") or []):
+            if meta is None or not isinstance(meta.get("path"), str):
+                continue
+            ids_by_path.setdefault(str(meta["path"]), []).append(chunk_id)
+        return cls(ids_by_path=ids_by_path, num_chunks=len(result["ids"]))
+
+    @property
+    def paths(self) -> list[str]:
+        return list(self.ids_by_path.keys())
+
+    def get_ids(self, paths: Iterable[str]) -> list[str]:
+        """
+        Return the ids of all chunks that belong to `paths`.
+        """
+        return [
+            chunk_id for path in paths for chunk_id in self.ids_by_path.get(path, [])
+        ]
+
+
 def verify_ef(collection: AsyncCollection, configs: Config):
     collection_ef = collection.metadata.get("embedding_function")
     collection_ep = collection.metadata.get("embedding_params")
@@ -22,7 +22,12 @@ from vectorcode.cli_utils import (
     load_config_file,
     parse_cli_args,
 )
-from vectorcode.common import get_client, get_collection, try_server
+from vectorcode.common import (
+    close_http_client,
+    get_client,
+    get_collection,
+    try_server,
+)
 from vectorcode.subcommands.query import get_query_result_files
 
 cached_project_configs: dict[str, Config] = {}
@@ -133,6 +138,11 @@ async def lsp_start() -> int:
                     file=sys.stderr,
                 )
 
+    @server.feature(types.SHUTDOWN)
+    async def shutdown(ls: LanguageServer, *args):
+        # the heartbeat client lives on the loop of the language server.
+        await close_http_client()
+
     await asyncio.to_thread(server.start_io)
 
     return 0
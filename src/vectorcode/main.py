@@ -4,6 +4,12 @@ import os
 import sys
 import traceback
 
+try:
+    import uvloop
+except ModuleNotFoundError:  # pragma: nocover
+    # not available on Windows.
+    uvloop = None
+
 from vectorcode import __version__
 from vectorcode.cli_utils import (
     CliAction,
@@ -11,7 +17,7 @@ from vectorcode.cli_utils import (
     get_project_config,
     parse_cli_args,
 )
-from vectorcode.common import start_server, try_server
+from vectorcode.common import close_http_client, start_server, try_server
 from vectorcode.subcommands import (
     check,
     clean,
@@ -88,11 +94,15 @@ async def async_main():
         if server_process is not None:
             server_process.terminate()
             await server_process.wait()
+        await close_http_client()
         return return_val
 
 
 def main():
-    return asyncio.run(async_main())
+    # uvloop has a much lower per-await overhead than the default event loop.
+    loop_factory = uvloop.new_event_loop if uvloop is not None else None
+    with asyncio.Runner(loop_factory=loop_factory) as runner:
+        return runner.run(async_main())
 
 
 if __name__ == "__main__":
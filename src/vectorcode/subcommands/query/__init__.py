@@ -1,4 +1,3 @@
-import json
 import os
 import sys
 
@@ -7,7 +6,7 @@ from chromadb.api.types import IncludeEnum
 from chromadb.errors import InvalidCollectionException, InvalidDimensionException
 
 from vectorcode.chunking import StringChunker
-from vectorcode.cli_utils import Config, expand_globs, expand_path
+from vectorcode.cli_utils import Config, expand_globs, expand_path, print_json
 from vectorcode.common import (
     get_client,
     get_collection,
@@ -43,14 +42,14 @@ async def get_query_result_files(
             filtered_files = {"path": {"$nin": configs.query_exclude}}
         else:
             filtered_files = None
+        include = [IncludeEnum.metadatas, IncludeEnum.distances]
+        if configs.reranker is not None:
+            # only the cross-encoder needs the chunks, so don't transfer them otherwise.
+            include.append(IncludeEnum.documents)
         results = await collection.query(
             query_texts=query_chunks,
             n_results=num_query,
-            include=[
-                IncludeEnum.metadatas,
-                IncludeEnum.distances,
-                IncludeEnum.documents,
-            ],
+            include=include,
             where=filtered_files,
         )
     except IndexError:
@@ -119,7 +118,7 @@ async def query(configs: Config) -> int:
             )
 
     if configs.pipe:
-        print(json.dumps(structured_result))
+        print_json(structured_result)
     else:
         for idx, result in enumerate(structured_result):
             for include_item in configs.include:
@@ -3,13 +3,21 @@ import os
 import sys
 from asyncio import Lock
 
-import tqdm
-from chromadb.api.types import IncludeEnum
 from chromadb.errors import InvalidCollectionException
 
 from vectorcode.cli_utils import Config
-from vectorcode.common import get_client, get_collection, verify_ef
-from vectorcode.subcommands.vectorise import chunked_add, show_stats
+from vectorcode.common import (
+    CollectionSnapshot,
+    get_client,
+    get_collection,
+    verify_ef,
+)
+from vectorcode.subcommands.vectorise import (
+    chunked_add,
+    find_orphanes,
+    make_progress_bar,
+    show_stats,
+)
 
 
 async def update(configs: Config) -> int:
@@ -28,34 +36,23 @@ async def update(configs: Config) -> int:
     if collection is None or not verify_ef(collection, configs):
         return 1
 
-    metas = (await collection.get(include=[IncludeEnum.metadatas]))["metadatas"]
-    if metas is None:
-        return 0
-    files_gen = (str(meta.get("path", "")) for meta in metas)
-    files = set()
-    orphanes = set()
-    for file in files_gen:
-        if os.path.isfile(file):
-            files.add(file)
-        else:
-            orphanes.add(file)
+    snapshot = await CollectionSnapshot.fetch(collection)
+    orphanes = await asyncio.to_thread(find_orphanes, snapshot.paths)
+    files = set(snapshot.paths) - orphanes
 
     stats = {"add": 0, "update": 0, "removed": len(orphanes)}
-    collection_lock = Lock()
     stats_lock = Lock()
     max_batch_size = await client.get_max_batch_size()
     semaphore = asyncio.Semaphore(os.cpu_count() or 1)
 
-    with tqdm.tqdm(
-        total=len(files), desc="Vectorising files...", disable=configs.pipe
-    ) as bar:
+    with make_progress_bar(len(files), configs) as bar:
         try:
             tasks = [
                 asyncio.create_task(
                     chunked_add(
                         str(file),
                         collection,
-                        collection_lock,
+                        snapshot,
                         stats,
                         stats_lock,
                         configs,
@@ -73,7 +70,7 @@ async def update(configs: Config) -> int:
             return 1
 
     if len(orphanes):
-        await collection.delete(where={"path": {"$in": list(orphanes)}})
+        await collection.delete(ids=snapshot.get_ids(orphanes))
 
     show_stats(configs, stats)
     return 0
@@ -1,21 +1,28 @@
 import asyncio
 import hashlib
-import json
+import itertools
 import os
 import sys
-import uuid
 from asyncio import Lock
-from typing import Iterable
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generator, Iterable, TypeVar
 
 import pathspec
 import tabulate
 import tqdm
 from chromadb.api.models.AsyncCollection import AsyncCollection
-from chromadb.api.types import IncludeEnum
 
 from vectorcode.chunking import FileChunker
-from vectorcode.cli_utils import Config, expand_globs, expand_path
-from vectorcode.common import get_client, get_collection, verify_ef
+from vectorcode.cli_utils import Config, expand_globs, expand_path, print_json
+from vectorcode.common import (
+    CollectionSnapshot,
+    get_client,
+    get_collection,
+    verify_ef,
+)
+
+T = TypeVar("T")
 
 
 def hash_str(string: str) -> str:
@@ -23,14 +30,85 @@ def hash_str(string: str) -> str:
     return hashlib.sha256(string.encode()).hexdigest()
 
 
-def get_uuid() -> str:
-    return uuid.uuid4().hex
+def get_chunk_id(file_path: str, chunk: str) -> str:
+    """
+    Derive a deterministic id from the content of a chunk, so that re-vectorising an
+    unchanged chunk maps to the id that is already in the database.
+    """
+    return hash_str(f"{file_path}\0{chunk}")
+
+
+def batched(iterable: Iterable[T], batch_size: int) -> Generator[list[T], None, None]:
+    iterator = iter(iterable)
+    while batch := list(itertools.islice(iterator, batch_size)):
+        yield batch
+
+
+def chunk_file(
+    file_path: str, configs: Config, batch_size: int
+) -> Generator[list[str], None, None]:
+    """
+    Lazily read and chunk a file, `batch_size` chunks at a time. Nothing is yielded
+    for an empty file.
+    Reading is blocking, so the batches should be pulled from a thread.
+    """
+    with open(file_path) as fin:
+        chunks = FileChunker(configs.chunk_size, configs.overlap_ratio).chunk(fin)
+        first_chunk = next(chunks, "")
+        if first_chunk == "":
+            # empty file
+            return
+        yield from batched(
+            itertools.chain(
+                [first_chunk],
+                chunks,
+                [str(os.path.relpath(file_path, configs.project_root))],
+            ),
+            batch_size,
+        )
+
+
+def get_live_files(directory: str, paths: set[str]) -> set[str]:
+    """
+    Return the paths in `directory` that are still files. The directory is listed
+    once with `os.scandir`, instead of calling `stat` on every path.
+    Paths that aren't in the listing are confirmed with `os.path.isfile`, because the
+    stored path may be spelt differently from the listed name (case-insensitive
+    filesystems, 8.3 short names, unicode normalisation).
+    """
+    try:
+        with os.scandir(directory) as entries:
+            live_paths = {entry.path for entry in entries if entry.is_file()} & paths
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+    except OSError:
+        # the directory may not be listable while the files are still accessible.
+        live_paths = set()
+    return live_paths | {path for path in paths - live_paths if os.path.isfile(path)}
+
+
+def find_orphanes(paths: Iterable[str]) -> set[str]:
+    """
+    Return the paths that are no longer files.
+    The parent directories are scanned in parallel, as the GIL is released while
+    waiting for the filesystem.
+    """
+    indexed_paths = frozenset(paths)
+    paths_by_dir: dict[str, set[str]] = defaultdict(set)
+    for path in indexed_paths:
+        paths_by_dir[os.path.dirname(path)].add(path)
+
+    with ThreadPoolExecutor() as executor:
+        live_paths = set().union(
+            *executor.map(get_live_files, paths_by_dir.keys(), paths_by_dir.values())
+        )
+    return set(indexed_paths - live_paths)
 
 
 async def chunked_add(
     file_path: str,
     collection: AsyncCollection,
-    collection_lock: Lock,
+    snapshot: CollectionSnapshot,
     stats: dict[str, int],
     stats_lock: Lock,
     configs: Config,
@@ -38,45 +116,58 @@ async def chunked_add(
     semaphore: asyncio.Semaphore,
 ):
     full_path_str = str(expand_path(str(file_path), True))
-    async with collection_lock:
-        num_existing_chunks = len(
-            (
-                await collection.get(
-                    where={"path": full_path_str},
-                    include=[IncludeEnum.metadatas],
-                )
-            )["ids"]
-        )
+    existing_chunk_ids = snapshot.ids_by_path.get(full_path_str, [])
+    known_ids = set(existing_chunk_ids)
+    # chromadb only reads the metadata, so all chunks of the file can share one dict.
+    chunk_meta = {"path": full_path_str}
 
-    if num_existing_chunks:
-        async with collection_lock:
-            await collection.delete(where={"path": full_path_str})
+    async with semaphore:
+        batches = chunk_file(full_path_str, configs, max_batch_size)
+        occurrences: dict[str, int] = defaultdict(int)
+        chunk_ids: set[str] = set()
+        inserted_ids: list[str] = []
+        try:
+            while (batch := await asyncio.to_thread(next, batches, None)) is not None:
+                ids: list[str] = []
+                inserted_chunks: list[str] = []
+                for chunk in batch:
+                    chunk_id = get_chunk_id(full_path_str, chunk)
+                    occurrence = occurrences[chunk_id]
+                    occurrences[chunk_id] += 1
+                    if occurrence:
+                        # identical chunks in the same file.
+                        chunk_id = f"{chunk_id}-{occurrence}"
+                    chunk_ids.add(chunk_id)
+                    if chunk_id not in known_ids:
+                        # only new chunks are sent, so unchanged ones aren't re-embedded.
+                        ids.append(chunk_id)
+                        inserted_chunks.append(chunk)
+                if ids:
+                    await collection.add(
+                        ids=ids,
+                        documents=inserted_chunks,
+                        metadatas=[chunk_meta] * len(inserted_chunks),
+                    )
+                    inserted_ids.extend(ids)
+        except UnicodeDecodeError:
+            # probably binary. skip it.
+            if inserted_ids or existing_chunk_ids:
+                await collection.delete(ids=existing_chunk_ids + inserted_ids)
+            return
+        finally:
+            # close the file when the database calls fail. A generator that's still
+            # being read by a cancelled thread can't be closed here.
+            if not batches.gi_running:
+                batches.close()
 
-    try:
-        async with semaphore:
-            with open(full_path_str) as fin:
-                chunks = list(
-                    FileChunker(configs.chunk_size, configs.overlap_ratio).chunk(fin)
-                )
-                if len(chunks) == 0 or (len(chunks) == 1 and chunks[0] == ""):
-                    # empty file
-                    return
-                chunks.append(str(os.path.relpath(full_path_str, configs.project_root)))
-                async with collection_lock:
-                    for idx in range(0, len(chunks), max_batch_size):
-                        inserted_chunks = chunks[idx : idx + max_batch_size]
-                        await collection.add(
-                            ids=[get_uuid() for _ in inserted_chunks],
-                            documents=inserted_chunks,
-                            metadatas=[
-                                {"path": full_path_str} for _ in inserted_chunks
-                            ],
-                        )
-    except UnicodeDecodeError:
-        # probably binary. skip it.
-        return
-
-    if num_existing_chunks:
+        stale_ids = [i for i in existing_chunk_ids if i not in chunk_ids]
+        if stale_ids:
+            await collection.delete(ids=stale_ids)
+        if not chunk_ids:
+            # empty file
+            return
+
+    if existing_chunk_ids:
         async with stats_lock:
             stats["update"] += 1
     else:
@@ -84,9 +175,22 @@ async def chunked_add(
             stats["add"] += 1
 
 
+def make_progress_bar(total: int, configs: Config) -> tqdm.tqdm:
+    """
+    The bar is redrawn at most ~100 times, so that it doesn't hold up the event loop.
+    """
+    return tqdm.tqdm(
+        total=total,
+        desc="Vectorising files...",
+        disable=configs.pipe,
+        miniters=max(1, total // 100),
+        mininterval=0.1,
+    )
+
+
 def show_stats(configs: Config, stats):
     if configs.pipe:
-        print(json.dumps(stats))
+        print_json(stats)
     else:
         print(
             tabulate.tabulate(
@@ -102,15 +206,17 @@ def show_stats(configs: Config, stats):
 def exclude_paths_by_spec(paths: Iterable[str], specs: pathspec.PathSpec) -> list[str]:
     """
     Files matched by the specs will be excluded.
+    The matching runs in C when pathspec finds the `re2` or `hyperscan` backend.
     """
-    return [path for path in paths if not specs.match_file(path)]
+    return list(specs.match_files(paths, negate=True))
 
 
 def include_paths_by_spec(paths: Iterable[str], specs: pathspec.PathSpec) -> list[str]:
     """
     Only include paths matched by the specs.
+    The matching runs in C when pathspec finds the `re2` or `hyperscan` backend.
     """
-    return [path for path in paths if specs.match_file(path)]
+    return list(specs.match_files(paths))
 
 
 def load_files_from_include(project_root: str) -> list[str]:
@@ -145,25 +251,30 @@ async def vectorise(configs: Config) -> int:
     )
     if os.path.isfile(gitignore_path) and not configs.force:
         with open(gitignore_path) as fin:
-            gitignore_spec = pathspec.GitIgnoreSpec.from_lines(fin.readlines())
+            gitignore_spec = pathspec.GitIgnoreSpec.from_lines(fin)
         files = exclude_paths_by_spec((str(i) for i in files), gitignore_spec)
 
+    # fetch the indexed chunks once, instead of probing the database for every file.
+    snapshot = await CollectionSnapshot.fetch(collection)
+
+    # the files being vectorised can't be orphanes, so the scan can run alongside.
+    orphanes_task = asyncio.create_task(
+        asyncio.to_thread(find_orphanes, snapshot.paths)
+    )
+
     stats = {"add": 0, "update": 0, "removed": 0}
-    collection_lock = Lock()
     stats_lock = Lock()
     max_batch_size = await client.get_max_batch_size()
     semaphore = asyncio.Semaphore(os.cpu_count() or 1)
 
-    with tqdm.tqdm(
-        total=len(files), desc="Vectorising files...", disable=configs.pipe
-    ) as bar:
+    with make_progress_bar(len(files), configs) as bar:
         try:
             tasks = [
                 asyncio.create_task(
                     chunked_add(
                         str(file),
                         collection,
-                        collection_lock,
+                        snapshot,
                         stats,
                         stats_lock,
                         configs,
@@ -176,22 +287,20 @@ async def vectorise(configs: Config) -> int:
             for task in asyncio.as_completed(tasks):
                 await task
                 bar.update(1)
+            orphanes = await orphanes_task
         except asyncio.CancelledError:
             print("Abort.", file=sys.stderr)
             return 1
+        finally:
+            # don't leave the scan pending when a file fails to be vectorised.
+            orphanes_task.cancel()
 
-    async with collection_lock:
-        all_results = await collection.get(include=[IncludeEnum.metadatas])
-        if all_results is not None and all_results.get("metadatas"):
-            paths = (meta["path"] for meta in all_results["metadatas"])
-            orphanes = set()
-            for path in paths:
-                if isinstance(path, str) and not os.path.isfile(path):
-                    orphanes.add(path)
-            async with stats_lock:
-                stats["removed"] = len(orphanes)
-            if len(orphanes):
-                await collection.delete(where={"path": {"$in": list(orphanes)}})
+    # the scan doesn't know about the files that were just vectorised.
+    orphanes = orphanes.difference(str(expand_path(str(file), True)) for file in files)
+    async with stats_lock:
+        stats["removed"] = len(orphanes)
+    if len(orphanes):
+        await collection.delete(ids=snapshot.get_ids(orphanes))
 
     show_stats(configs=configs, stats=stats)
     return 0
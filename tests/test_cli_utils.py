@@ -18,6 +18,7 @@ from vectorcode.cli_utils import (
     get_project_config,
     load_config_file,
     parse_cli_args,
+    print_json,
 )
 
 
@@ -394,3 +395,15 @@ async def test_parse_cli_args_clean():
     with patch("sys.argv", ["vectorcode", "clean"]):
         config = await parse_cli_args()
         assert config.action == CliAction.clean
+
+
+def test_print_json(capsys):
+    data = [{"path": "café.py", "document": "print('hi')\n", "size": 1}]
+
+    print_json(data)
+    assert json.loads(capsys.readouterr().out) == data
+
+    # fallback when orjson is not installed
+    with patch("vectorcode.cli_utils.orjson", None):
+        print_json(data)
+    assert json.loads(capsys.readouterr().out) == data
@@ -1,9 +1,13 @@
+import asyncio
+import gc
+import hashlib
 import os
 import socket
 import subprocess
 import sys
 import tempfile
-from unittest.mock import MagicMock, patch
+import weakref
+from unittest.mock import AsyncMock, MagicMock, patch
 
 import httpx
 import pytest
@@ -12,11 +16,14 @@ from chromadb.api.models.AsyncCollection import AsyncCollection
 
 from vectorcode.cli_utils import Config
 from vectorcode.common import (
+    CollectionSnapshot,
+    close_http_client,
     get_client,
     get_collection,
     get_collection_name,
     get_collections,
     get_embedding_function,
+    get_http_client,
     start_server,
     try_server,
     verify_ef,
@@ -24,6 +31,15 @@ from vectorcode.common import (
 )
 
 
+@pytest.fixture(autouse=True)
+def clear_embedding_function_cache():
+    from vectorcode.common import __EMBEDDING_FUNCTION_CACHE
+
+    __EMBEDDING_FUNCTION_CACHE.clear()
+    yield
+    __EMBEDDING_FUNCTION_CACHE.clear()
+
+
 def test_get_collection_name():
     with tempfile.TemporaryDirectory(dir="/tmp") as temp_dir:
         file_path = os.path.join(temp_dir, "test_file.txt")
@@ -45,6 +61,15 @@ def test_get_collection_name():
         collection_name3 = get_collection_name(abs_file_path)
         assert collection_name == collection_name3
 
+        # Test that the hash stays compatible with existing collections
+        user = os.environ.get("USER", os.environ.get("USERNAME", "DEFAULT_USER"))
+        assert (
+            collection_name
+            == hashlib.sha256(
+                f"{user}@{socket.gethostname()}:{abs_file_path}".encode()
+            ).hexdigest()[:63]
+        )
+
 
 def test_get_embedding_function():
     # Test with a valid embedding function
@@ -68,6 +93,76 @@ def test_get_embedding_function():
     assert "SentenceTransformerEmbeddingFunction" in str(type(embedding_function))
 
 
+def test_get_embedding_function_device():
+    with (
+        patch(
+            "chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction"
+        ) as MockEmbeddingFunction,
+        patch("torch.cuda.is_available", return_value=True),
+    ):
+        # The device is picked automatically when not configured.
+        get_embedding_function(Config(embedding_params={}))
+        assert MockEmbeddingFunction.call_args.kwargs["device"] == "cuda"
+
+        # A configured device is respected.
+        get_embedding_function(Config(embedding_params={"device": "cpu"}))
+        assert MockEmbeddingFunction.call_args.kwargs["device"] == "cpu"
+
+        # Other backends manage their own devices.
+        get_embedding_function(Config(embedding_params={"backend": "openvino"}))
+        assert "device" not in MockEmbeddingFunction.call_args.kwargs
+
+
+def test_get_embedding_function_device_cpu():
+    with (
+        patch(
+            "chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction"
+        ) as MockEmbeddingFunction,
+        patch("torch.cuda.is_available", return_value=False),
+        patch("torch.backends.mps.is_available", return_value=False),
+    ):
+        get_embedding_function(Config(embedding_params={}))
+        assert MockEmbeddingFunction.call_args.kwargs["device"] == "cpu"
+
+
+def test_get_embedding_function_cache():
+    with patch(
+        "chromadb.utils.embedding_functions.OllamaEmbeddingFunction"
+    ) as MockEmbeddingFunction:
+        MockEmbeddingFunction.side_effect = lambda **kwargs: MagicMock()
+        config = Config(
+            embedding_function="OllamaEmbeddingFunction",
+            embedding_params={"model_name": "nomic-embed-text", "options": {"a": 1}},
+        )
+        embedding_function = get_embedding_function(config)
+        # same name and parameters: the cached instance is reused.
+        assert (
+            get_embedding_function(
+                Config(
+                    embedding_function="OllamaEmbeddingFunction",
+                    embedding_params={
+                        "options": {"a": 1},
+                        "model_name": "nomic-embed-text",
+                    },
+                )
+            )
+            is embedding_function
+        )
+        MockEmbeddingFunction.assert_called_once()
+
+        # different parameters: a new instance is created.
+        assert (
+            get_embedding_function(
+                Config(
+                    embedding_function="OllamaEmbeddingFunction",
+                    embedding_params={"model_name": "other-model"},
+                )
+            )
+            is not embedding_function
+        )
+        assert MockEmbeddingFunction.call_count == 2
+
+
 @pytest.mark.asyncio
 async def test_try_server():
     # This test requires a server to be running, so it's difficult to make it truly isolated.
@@ -173,30 +268,56 @@ def test_verify_ef():
 @patch("socket.socket")
 @pytest.mark.asyncio
 async def test_try_server_mocked(mock_socket):
-    # Mocking httpx.AsyncClient and its get method to simulate a successful connection
-    with patch("httpx.AsyncClient") as mock_client:
+    # Mocking the shared httpx.AsyncClient to simulate a successful connection
+    with patch("vectorcode.common.get_http_client") as mock_client:
         mock_response = MagicMock()
         mock_response.status_code = 200
-        mock_client.return_value.__aenter__.return_value.get.return_value = (
-            mock_response
-        )
+        mock_client.return_value.get = AsyncMock(return_value=mock_response)
         assert await try_server("localhost", 8000) is True
 
-    # Mocking httpx.AsyncClient to raise a ConnectError
-    with patch("httpx.AsyncClient") as mock_client:
-        mock_client.return_value.__aenter__.return_value.get.side_effect = (
-            httpx.ConnectError("Simulated connection error")
+    # Mocking the shared httpx.AsyncClient to raise a ConnectError
+    with patch("vectorcode.common.get_http_client") as mock_client:
+        mock_client.return_value.get = AsyncMock(
+            side_effect=httpx.ConnectError("Simulated connection error")
         )
         assert await try_server("localhost", 8000) is False
 
-    # Mocking httpx.AsyncClient to raise a ConnectTimeout
-    with patch("httpx.AsyncClient") as mock_client:
-        mock_client.return_value.__aenter__.return_value.get.side_effect = (
-            httpx.ConnectTimeout("Simulated connection timeout")
+    # Mocking the shared httpx.AsyncClient to raise a ConnectTimeout
+    with patch("vectorcode.common.get_http_client") as mock_client:
+        mock_client.return_value.get = AsyncMock(
+            side_effect=httpx.ConnectTimeout("Simulated connection timeout")
         )
         assert await try_server("localhost", 8000) is False
 
 
+@pytest.mark.asyncio
+async def test_get_http_client():
+    client = get_http_client()
+    assert isinstance(client, httpx.AsyncClient)
+    # the client is reused within the same event loop.
+    assert get_http_client() is client
+
+    await close_http_client()
+    assert client.is_closed
+    new_client = get_http_client()
+    assert new_client is not client
+    await close_http_client()
+
+
+def test_get_http_client_releases_loop():
+    async def get_client_on_loop():
+        get_http_client()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(get_client_on_loop())
+    loop.close()
+    loop_ref = weakref.ref(loop)
+    del loop
+    gc.collect()
+    # the cache doesn't keep a closed loop alive.
+    assert loop_ref() is None
+
+
 @pytest.mark.asyncio
 async def test_get_collection():
     config = Config(
@@ -398,10 +519,61 @@ def test_get_embedding_function_fallback():
 
 @pytest.mark.asyncio
 async def test_wait_for_server_request_error():
-    # Mocking httpx.AsyncClient to raise a RequestError
-    with patch("httpx.AsyncClient") as mock_client:
-        mock_client.return_value.__aenter__.return_value.get.side_effect = (
-            httpx.RequestError("Simulated request error")
+    # Mocking the shared httpx.AsyncClient to raise a RequestError
+    with patch("vectorcode.common.get_http_client") as mock_client:
+        mock_client.return_value.get = AsyncMock(
+            side_effect=httpx.RequestError("Simulated request error")
         )
         with pytest.raises(TimeoutError):
             await wait_for_server("localhost", 9999, timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_wait_for_server_backoff():
+    mock_response = MagicMock()
+    mock_response.status_code = 200
+    with (
+        patch("vectorcode.common.get_http_client") as mock_client,
+        patch("vectorcode.common.asyncio.sleep") as mock_sleep,
+    ):
+        mock_client.return_value.get = AsyncMock(
+            side_effect=[httpx.RequestError("Simulated request error")] * 15
+            + [mock_response]
+        )
+        await wait_for_server("localhost", 9999, timeout=10)
+
+        delays = [call.args[0] for call in mock_sleep.call_args_list]
+        assert len(delays) == 15
+        # starts small, grows and is capped (including the jitter).
+        assert 0.01 <= delays[0] <= 0.0125
+        assert delays[-1] > delays[0]
+        assert all(0.2 <= delay <= 0.25 for delay in delays[-3:])
+        assert mock_client.return_value.get.call_args.kwargs["timeout"] == 0.5
+
+
+@pytest.mark.asyncio
+async def test_collection_snapshot():
+    mock_collection = MagicMock(spec=AsyncCollection)
+    mock_collection.get.return_value = {
+        "ids": ["id1", "id2", "id3", "id4", "id5"],
+        "metadatas": [
+            {"path": "/project/a.py"},
+            {"path": "/project/b.py"},
+            {"path": "/project/a.py"},
+            None,
+            {"other": "value"},
+        ],
+    }
+
+    snapshot = await CollectionSnapshot.fetch(mock_collection)
+    mock_collection.get.assert_called_once()
+    assert snapshot.num_chunks == 5
+    assert snapshot.ids_by_path == {
+        "/project/a.py": ["id1", "id3"],
+        "/project/b.py": ["id2"],
+    }
+    assert sorted(snapshot.paths) == ["/project/a.py", "/project/b.py"]
+    assert snapshot.get_ids(["/project/a.py", "/project/missing.py"]) == [
+        "id1",
+        "id3",
+    ]
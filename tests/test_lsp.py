@@ -0,0 +1,36 @@
+import asyncio
+import sys
+import tempfile
+from unittest.mock import patch
+
+import pytest
+
+pytest.importorskip("pygls")
+
+from lsprotocol import types  # noqa: E402
+from pygls.server import LanguageServer  # noqa: E402
+
+from vectorcode.common import get_http_client  # noqa: E402
+from vectorcode.lsp_main import lsp_start  # noqa: E402
+
+
+@pytest.mark.asyncio
+async def test_lsp_shutdown_closes_http_client():
+    servers: list[LanguageServer] = []
+    with (
+        tempfile.TemporaryDirectory() as temp_dir,
+        patch.object(sys, "argv", ["vectorcode-server", "--project_root", temp_dir]),
+        patch.object(
+            LanguageServer,
+            "start_io",
+            autospec=True,
+            side_effect=lambda server: servers.append(server),
+        ),
+    ):
+        assert await lsp_start() == 0
+
+    client = get_http_client()
+    # this is what the server runs when it receives a `shutdown` request.
+    servers[0].lsp._get_handler(types.SHUTDOWN)()
+    await asyncio.sleep(0.1)
+    assert client.is_closed
@@ -0,0 +1,248 @@
+import asyncio
+import os
+import tempfile
+import threading
+from asyncio import Lock
+from contextlib import contextmanager
+from unittest.mock import AsyncMock, patch
+
+import pytest
+
+from vectorcode.cli_utils import Config
+from vectorcode.common import CollectionSnapshot
+from vectorcode.subcommands.vectorise import (
+    batched,
+    chunk_file,
+    chunked_add,
+    find_orphanes,
+    get_chunk_id,
+    vectorise,
+)
+
+
+def test_find_orphanes():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        live_file = os.path.join(temp_dir, "live.py")
+        with open(live_file, "w") as fin:
+            fin.write("hello")
+        os.makedirs(os.path.join(temp_dir, "sub"))
+        deleted_file = os.path.join(temp_dir, "sub", "deleted.py")
+        missing_dir_file = os.path.join(temp_dir, "missing", "file.py")
+
+        assert find_orphanes([live_file, deleted_file, missing_dir_file]) == {
+            deleted_file,
+            missing_dir_file,
+        }
+
+
+def test_find_orphanes_unlisted_file():
+    # the stored path may be spelt differently from the name listed by `scandir`,
+    # eg. on case-insensitive filesystems.
+    with tempfile.TemporaryDirectory() as temp_dir:
+        live_file = os.path.join(temp_dir, "Live.py")
+        with open(live_file, "w") as fin:
+            fin.write("hello")
+
+        @contextmanager
+        def empty_scandir(_):
+            yield iter(())
+
+        with patch("os.scandir", side_effect=empty_scandir):
+            assert find_orphanes([live_file]) == set()
+
+
+class FakeCollection:
+    """
+    An in-memory stand-in for `AsyncCollection` that records the writes.
+    """
+
+    def __init__(self):
+        self.chunks: dict[str, tuple[str, dict]] = {}
+        self.added_ids: list[list[str]] = []
+        self.deleted_ids: list[list[str]] = []
+
+    async def add(self, ids, documents, metadatas):
+        self.added_ids.append(list(ids))
+        for chunk_id, document, meta in zip(ids, documents, metadatas):
+            assert chunk_id not in self.chunks
+            self.chunks[chunk_id] = (document, meta)
+
+    async def delete(self, ids):
+        self.deleted_ids.append(list(ids))
+        for chunk_id in ids:
+            self.chunks.pop(chunk_id)
+
+    async def get(self, include=None):
+        return {
+            "ids": list(self.chunks.keys()),
+            "metadatas": [meta for _, meta in self.chunks.values()],
+        }
+
+
+async def run_chunked_add(file_path: str, collection: FakeCollection, configs):
+    stats = {"add": 0, "update": 0, "removed": 0}
+    collection.added_ids.clear()
+    collection.deleted_ids.clear()
+    await chunked_add(
+        file_path,
+        collection,  # type: ignore
+        await CollectionSnapshot.fetch(collection),  # type: ignore
+        stats,
+        Lock(),
+        configs,
+        2,
+        asyncio.Semaphore(1),
+    )
+    return stats
+
+
+@pytest.mark.asyncio
+async def test_chunked_add():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "file.txt")
+        configs = Config(chunk_size=5, overlap_ratio=0, project_root=temp_dir)
+        collection = FakeCollection()
+        with open(file_path, "w") as fin:
+            fin.write("aaaaabbbbbaaaaac")
+
+        # first index
+        stats = await run_chunked_add(file_path, collection, configs)
+        assert stats["add"] == 1 and stats["update"] == 0
+        chunk_a = get_chunk_id(file_path, "aaaaa")
+        expected_ids = {
+            chunk_a,
+            get_chunk_id(file_path, "bbbbb"),
+            f"{chunk_a}-1",
+            get_chunk_id(file_path, "c"),
+            get_chunk_id(file_path, "file.txt"),
+        }
+        assert set(collection.chunks.keys()) == expected_ids
+        # batches of 2 chunks.
+        assert [len(i) for i in collection.added_ids] == [2, 2, 1]
+        assert all(
+            meta == {"path": file_path} for _, meta in collection.chunks.values()
+        )
+
+        # unchanged re-run
+        stats = await run_chunked_add(file_path, collection, configs)
+        assert stats["add"] == 0 and stats["update"] == 1
+        assert collection.added_ids == []
+        assert collection.deleted_ids == []
+        assert set(collection.chunks.keys()) == expected_ids
+
+        # modified file
+        with open(file_path, "w") as fin:
+            fin.write("aaaaacccccaaaaac")
+        stats = await run_chunked_add(file_path, collection, configs)
+        assert stats["update"] == 1
+        assert collection.added_ids == [[get_chunk_id(file_path, "ccccc")]]
+        assert collection.deleted_ids == [[get_chunk_id(file_path, "bbbbb")]]
+        assert [doc for doc, _ in collection.chunks.values()].count("aaaaa") == 2
+
+        # emptied file
+        with open(file_path, "w") as fin:
+            fin.write("")
+        stats = await run_chunked_add(file_path, collection, configs)
+        assert stats["add"] == 0 and stats["update"] == 0
+        assert collection.added_ids == []
+        assert collection.chunks == {}
+
+
+@pytest.mark.asyncio
+async def test_chunked_add_binary_after_text():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "file.txt")
+        configs = Config(chunk_size=5, overlap_ratio=0, project_root=temp_dir)
+        collection = FakeCollection()
+        with open(file_path, "w") as fin:
+            fin.write("aaaaabbbbb")
+        await run_chunked_add(file_path, collection, configs)
+        assert collection.chunks
+
+        # enough text for some batches to be inserted before the decoding fails.
+        with open(file_path, "wb") as fin:
+            fin.write(b"0123456789" * 2000 + b"\xff\xfe\x00binary")
+        stats = await run_chunked_add(file_path, collection, configs)
+        assert collection.added_ids
+        assert stats["add"] == 0 and stats["update"] == 0
+        # both the previously indexed and the newly inserted chunks are removed.
+        assert collection.chunks == {}
+
+
+def test_batched():
+    assert list(batched(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batched(range(4), 2)) == [[0, 1], [2, 3]]
+    assert list(batched([], 2)) == []
+
+
+def test_chunk_file():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "file.txt")
+        configs = Config(chunk_size=5, overlap_ratio=0, project_root=temp_dir)
+        with open(file_path, "w") as fin:
+            fin.write("")
+        assert list(chunk_file(file_path, configs, 2)) == []
+
+        with open(file_path, "w") as fin:
+            fin.write("aaaaabbbbbc")
+        assert list(chunk_file(file_path, configs, 2)) == [
+            ["aaaaa", "bbbbb"],
+            ["c", "file.txt"],
+        ]
+        assert list(chunk_file(file_path, configs, 10)) == [
+            ["aaaaa", "bbbbb", "c", "file.txt"]
+        ]
+
+
+@pytest.mark.asyncio
+async def test_chunked_add_closes_file():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "file.txt")
+        configs = Config(chunk_size=5, overlap_ratio=0, project_root=temp_dir)
+        with open(file_path, "w") as fin:
+            fin.write("aaaaabbbbbc")
+        collection = FakeCollection()
+        collection.add = AsyncMock(side_effect=RuntimeError)  # type: ignore
+
+        batches = chunk_file(file_path, configs, 2)
+        with (
+            patch("vectorcode.subcommands.vectorise.chunk_file", return_value=batches),
+            pytest.raises(RuntimeError),
+        ):
+            await run_chunked_add(file_path, collection, configs)
+        assert batches.gi_frame is None
+
+
+@pytest.mark.asyncio
+async def test_vectorise_cancels_orphan_scan_on_error():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "file.txt")
+        with open(file_path, "w") as fin:
+            fin.write("hello")
+        configs = Config(files=[file_path], project_root=temp_dir, pipe=True)
+        client = AsyncMock()
+        client.get_max_batch_size.return_value = 2
+        scan_finished = threading.Event()
+
+        with (
+            patch("vectorcode.subcommands.vectorise.get_client", return_value=client),
+            patch(
+                "vectorcode.subcommands.vectorise.get_collection",
+                return_value=FakeCollection(),
+            ),
+            patch("vectorcode.subcommands.vectorise.verify_ef", return_value=True),
+            patch(
+                "vectorcode.subcommands.vectorise.chunked_add",
+                side_effect=RuntimeError,
+            ),
+            patch(
+                "vectorcode.subcommands.vectorise.find_orphanes",
+                side_effect=lambda _: scan_finished.wait(5) and set(),
+            ),
+            pytest.raises(RuntimeError),
+        ):
+            await vectorise(configs)
+        await asyncio.sleep(0)
+        # the orphan scan isn't left pending.
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+        scan_finished.set()